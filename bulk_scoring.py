@@ -0,0 +1,281 @@
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import pickle
+import queue
+import re
+import sys
+import threading
+import time
+from functools import partial
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn.functional as F
+from transformers import BertTokenizer, BertForSequenceClassification
+
+import feature_extraction
+import feature_extraction_hard_spam
+from feature_extraction import CSV_COLUMNS, FEATURES
+from mail_ingestion import iter_maildir, iter_mbox, read_message
+from robust_extraction import TIMEOUT, iter_isolated, write_errors
+
+# columns of the metadata features, same as the notebook
+ONE_HOT_COLUMNS = ["content_type", "content_disp", "domain", "time_period"]
+INT_COLUMNS = [
+    "has_subject", "num_html", "has_attachement", "num_exc_mark", "has_list_id", "check_spf", "check_dkim",
+    "from_returnpath_same", "num_received", "is_replied", "time_period", "is_weekday"
+]
+# emails per tokenizer and model batch
+BATCH_SIZE = 64
+# batches waiting between two stages
+QUEUE_SIZE = 4
+
+
+def text_preprocessing(email_content):
+
+    email_content = email_content.replace("\n", " ").replace("\r", " ").replace("\t", " ")
+    email_content = re.sub(r'(?:[A-Za-z0-9+/]{2,4}){4,}', ' ', email_content)
+    email_content = re.sub(r'((.{1,4}?))(\1){3,}', r'\1', email_content)
+    email_content = re.sub(r'([/+=\\\-])\1{3,}', ' ', email_content)
+    email_content = re.sub(r"<[^>]+>", " ", email_content)
+    email_content = re.sub(r"https?://\S+|www\.\S+", "[URL]", email_content)
+    email_content = re.sub(r"\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b", "[EMAIL]", email_content)
+    email_content = re.sub(r'[^a-zA-Z0-9.,!?\"\s]', " ", email_content)
+    email_content = re.sub(r"\s+", " ", email_content).strip()
+
+    return email_content
+
+
+def iter_emails(input_path, chunksize=1000):
+    """
+    Streams the raw emails of a csv like spam_assassin.csv or a folder of json emails like hard_spam.
+    An mbox file or a Maildir tree is streamed as byte ranges and file paths the workers read themselves.
+    Returns: (kind, generator of raw emails or their sources)
+    """
+    input_path = Path(input_path)
+    if (input_path / "cur").is_dir() or (input_path / "new").is_dir():
+        return "mailbox", iter_maildir(input_path)
+    if input_path.is_file() and input_path.suffix != ".csv":
+        return "mailbox", iter_mbox(input_path)
+    if input_path.is_dir():
+        def emails():
+            for f in sorted(input_path.glob("*.json")):
+                with open(f, "r", encoding = "utf-8") as fp:
+                    yield json.load(fp)["text"]
+        return "json", emails()
+
+    def emails():
+        for chunk in pd.read_csv(input_path, chunksize=chunksize):
+            yield from chunk.iloc[:, 0]
+    return "csv", emails()
+
+
+def prepare(kind, emails):
+    """
+    Runs in a parse worker: extracts the metadata features and the preprocessed content of one email.
+    Exceptions are left to the supervised worker, which reports them like every other failure.
+    Returns: (features, preprocessed content, seconds spent)
+    """
+    start = time.perf_counter()
+    if kind == "mailbox":
+        emails = read_message(emails)
+    if kind == "json":
+        features = feature_extraction_hard_spam.feature_extraction(emails)
+    else:
+        features = feature_extraction.feature_extraction(emails)
+    content = features[FEATURES.index("process_content")]
+    preprocessed = text_preprocessing(content) if isinstance(content, str) else "None"
+    return features, preprocessed, time.perf_counter() - start
+
+
+def metadata_frame(features, models):
+    """
+    Cleans and encodes a batch of metadata features the same way the notebook does before training.
+    """
+    df = pd.DataFrame(features, columns=FEATURES)[CSV_COLUMNS]
+    df = df.replace("None", np.nan)
+    df = df.map(lambda x: x.lower().strip() if isinstance(x, str) else x)
+
+    # cleaning feature content_type and content_disp
+    df["content_type"] = df["content_type"].apply(lambda x: x.split("text/html")[0] + "text/html" if isinstance(x, str) and "text/html" in x else x)
+    df["content_type"] = df["content_type"].apply(lambda x: x.split("text/plain")[0] + "text/plain" if isinstance(x, str) and "text/plain" in x else x)
+    df["content_type"] = df["content_type"].apply(lambda x: x.split("application")[0] + "application" if isinstance(x, str) and "application" in x else x)
+    df["content_disp"] = df["content_disp"].apply(lambda x: x.split(";")[0] if isinstance(x, str) and ";" in x else x)
+    df["content_disp"] = df["content_disp"].apply(lambda x: x.split("inline")[0] + "inline" if isinstance(x, str) and "inline" in x else x)
+
+    # change categorical data into integer and keep the domains seen often enough in training
+    df[INT_COLUMNS] = df[INT_COLUMNS].apply(pd.to_numeric, errors = "coerce").astype("Int64")
+    df["domain"] = df["domain"].apply(lambda x: x if isinstance(x, str) and x in models["domains"] else "Other")
+
+    # apply the fitted one hot encoding and replace na with the training medians
+    encoder = models["encoder"]
+    encoded_cats = encoder.transform(df[ONE_HOT_COLUMNS])
+    encoded_df = pd.DataFrame(encoded_cats, columns = encoder.get_feature_names_out(ONE_HOT_COLUMNS)).astype(int)
+    encoded_df[df[ONE_HOT_COLUMNS].isna()] = pd.NA
+    df = df.drop(columns = ONE_HOT_COLUMNS).join(encoded_df)
+    df = df.fillna(models["medians"])
+    return df[models["columns"]]
+
+
+def run_stage(name, func, inbox, outbox, busy, failures):
+    """
+    Runs a pipeline stage in a thread: applies func to every batch of its inbox and passes the result on.
+    After a failure anywhere in the pipeline the remaining batches are drained so no stage blocks.
+    """
+    while True:
+        batch = inbox.get()
+        if batch is None:
+            break
+        if failures:
+            continue
+        start = time.perf_counter()
+        try:
+            result = func(batch)
+        except Exception as e:
+            failures.append((name, e))
+            continue
+        busy[name] += time.perf_counter() - start
+        if outbox is not None:
+            outbox.put(result)
+    if outbox is not None:
+        outbox.put(None)
+
+
+def bulk_scoring(input_path, output, models_path, bert_path, parse_workers=None, batch_size=BATCH_SIZE, queue_size=QUEUE_SIZE, timeout=TIMEOUT):
+    """
+    Scores every email of an input with the hybrid model, overlapping the pipeline stages:
+    feature extraction and text preprocessing in supervised worker processes, tokenization in a thread,
+    the metadata random forest and BERT in threads on the remaining cores, and a writer
+    that streams the probabilities to a csv as batches finish.
+    Returns: the utilization of every stage
+    """
+    cores = os.cpu_count() or 1
+    if parse_workers is None:
+        parse_workers = max(1, cores // 2)
+
+    # a worker that hangs or dies is replaced while the stage threads run, so workers come from a
+    # fork server that has no threads instead of being forked from this process, and the
+    # fork server imports this script once so a new worker starts without importing it again
+    mp_context = multiprocessing.get_context("forkserver")
+    mp_context.set_forkserver_preload(["__main__"])
+    torch.set_num_threads(max(1, cores - parse_workers))
+
+    with open(models_path, "rb") as f:
+        models = pickle.load(f)
+    tokenizer = BertTokenizer.from_pretrained(bert_path)
+    model_bert = BertForSequenceClassification.from_pretrained(bert_path)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model_bert.to(device)
+    model_bert.eval()
+
+    def tokenize(batch):
+        batch["tokens"] = tokenizer(batch["contents"], truncation = True, padding = True, max_length = 512, return_tensors = "pt")
+        return batch
+
+    def metadata(batch):
+        X = metadata_frame(batch["features"], models)
+        batch["metadata_prob"] = models["metadata_model"].predict_proba(X)[:, 1]
+        return batch
+
+    def bert(batch):
+        tokens = batch["tokens"]
+        with torch.no_grad():
+            outputs = model_bert(input_ids = tokens["input_ids"].to(device), attention_mask = tokens["attention_mask"].to(device))
+        batch["bert_prob"] = F.softmax(outputs.logits, dim = 1)[:, 1].cpu().numpy()
+        return batch
+
+    out = open(output, "w", newline = "")
+    writer = csv.writer(out)
+    writer.writerow(["index", "metadata_prob", "bert_prob", "spam_prob"])
+
+    def write(batch):
+        # same column order as the notebook: BERT probability, then the metadata probability
+        comb = np.column_stack((batch["bert_prob"], batch["metadata_prob"]))
+        spam_prob = models["meta_classifier"].predict_proba(comb)[:, 1]
+        writer.writerows(zip(batch["indices"], batch["metadata_prob"], batch["bert_prob"], spam_prob))
+        out.flush()
+
+    stages = [("tokenize", tokenize), ("metadata", metadata), ("bert", bert), ("write", write)]
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    busy = {name: 0.0 for name, _ in stages}
+    busy["parse"] = 0.0
+    failures = []
+    threads = []
+    for i, (name, func) in enumerate(stages):
+        outbox = queues[i + 1] if i + 1 < len(stages) else None
+        thread = threading.Thread(target=run_stage, args=(name, func, queues[i], outbox, busy, failures), daemon=True)
+        thread.start()
+        threads.append(thread)
+
+    kind, emails = iter_emails(input_path)
+    errors = []
+    batch = {"indices": [], "features": [], "contents": []}
+    wall_start = time.perf_counter()
+
+    # every email is parsed in a supervised worker with its own time limit, a bounded number
+    # of emails is in flight and the results come back in order
+    results = iter_isolated(partial(prepare, kind), emails, timeout, parse_workers, mp_context, parse_workers * batch_size)
+    try:
+        for index, result, error in results:
+            if failures:
+                break
+            if error is not None:
+                errors.append((index,) + tuple(error))
+                continue
+            features, content, seconds = result
+            busy["parse"] += seconds
+            batch["indices"].append(index)
+            batch["features"].append(features)
+            batch["contents"].append(content)
+            if len(batch["indices"]) == batch_size:
+                queues[0].put(batch)
+                batch = {"indices": [], "features": [], "contents": []}
+        else:
+            if batch["indices"]:
+                queues[0].put(batch)
+    finally:
+        # stop the workers and the stage threads and close the output even if parsing failed
+        results.close()
+        queues[0].put(None)
+        for thread in threads:
+            thread.join()
+        out.close()
+    wall = time.perf_counter() - wall_start
+
+    write_errors(errors, Path(output).with_name(Path(output).stem + "_errors.csv"))
+    if failures:
+        name, e = failures[0]
+        raise RuntimeError(f"stage {name} failed") from e
+
+    utilization = {"parse": busy["parse"] / (wall * parse_workers)}
+    for name, _ in stages:
+        utilization[name] = busy[name] / wall
+    return utilization
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Score a large mail archive with the hybrid model in a pipeline")
+    parser.add_argument("input", help="a csv like spam_assassin.csv, a folder of json emails like hard_spam, an mbox file or a Maildir tree")
+    parser.add_argument("output", help="csv the probabilities are streamed to")
+    parser.add_argument("--models", default="hybrid_model.pkl", help="pickle saved by model_creation.ipynb (default hybrid_model.pkl)")
+    parser.add_argument("--bert", default="bert_model", help="folder of the fine-tuned BERT model and tokenizer (default bert_model)")
+    parser.add_argument("--parse-workers", type=int, default=None, help="processes for feature extraction (default half of the cores)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--queue-size", type=int, default=QUEUE_SIZE, help="batches buffered between two stages")
+    parser.add_argument("--timeout", type=float, default=TIMEOUT, help=f"wall-clock budget in seconds per email (default {TIMEOUT})")
+    args = parser.parse_args()
+
+    utilization = bulk_scoring(
+        args.input, args.output, args.models, args.bert, args.parse_workers, args.batch_size, args.queue_size, args.timeout
+    )
+
+    # the busiest stage is the bottleneck of the pipeline
+    for name, value in utilization.items():
+        print(f"{name:>10}: {value:.0%} busy", file=sys.stderr)
+    print(f"bottleneck: {max(utilization, key=utilization.get)}", file=sys.stderr)
@@ -7,8 +7,8 @@ import dns.resolver
 from bs4 import BeautifulSoup
 import urllib.parse
 import csv
-
-df = pd.read_csv("spam_assassin.csv")
+import io
+from mail_ingestion import RawMessage, iter_maildir, iter_mbox, read_message
 
 def check_spf(domain):
     """
@@ -84,63 +84,212 @@ def check_dkim(domain):
             return None
     return 1 if dkim_found else 0
 
-def feature_extraction(emails):
-
-    headers = [
-        "Return-Path:",
-        "Delivered-To:",
-        "Received:",
-        "Date:",
-        "From",
-        "To:",
-        "Subject:",
-        "Message-Id:",
-        "Mail-Followup-To:",
-        "References:",
-        "MIME-Version:",
-        "Content-Type:",
-        "Content-Disposition:",
-        "User-Agent:",
-        "Sender:",
-        "Errors-To:",
-        "X-Mailman-Version:",
-        "Precedence:",
-        "List-Id:",
-        "X-Beenthere:",
-        "In-Reply-To:",
-        "load average:",
-        "List maintainer:",
-        "Content-Transfer-Encoding:",
-        "Delivery-Date:",
-        "List-Archive:",
-        "X-Priority:",
-        "X-Msmail-Priority:",
-        "X-Mailer:",
-        "X-Mimeole:",
-        "List-Help:",
-        "List-Post:",
-        "List-Subscribe:",
-        "List-Unsubscribe:"
-    ]
+# headers are searched for a blank line only within this many characters
+MAX_HEADER_BYTES = 64 * 1024
+# default byte budget for the text parts in bounded mode, a flattened email has no separate body
+# and is read up to MAX_HEADER_BYTES plus the budget since its header block is counted apart
+MAX_BODY_BYTES = 256 * 1024
 
-    # Check if the email is in HTML format
-    if re.search(r"<html|<body|<div|<span|<p>", emails, re.IGNORECASE):
-        html_format = True
+
+def find_blank_line(emails, start, end):
+    """
+    Finds the first blank line between start and end, either "\n\n" or "\r\n\r\n".
+    Returns: (header_end, body_start), or (-1, -1) if there is none
+    """
+    lf = emails.find("\n\n", start, end)
+    crlf = emails.find("\r\n\r\n", start, end)
+    if crlf != -1 and (lf == -1 or crlf < lf):
+        return crlf, crlf + 4
+    if lf != -1:
+        return lf, lf + 2
+    return -1, -1
+
+
+def parse_headers(emails, headers, head_limit=None):
+    """
+    Parses the header block of a raw email without touching its body.
+    A flattened email has no blank line and keeps its body in the last header, cut at head_limit.
+    Returns: (msg, head, body_start, truncated)
+    """
+    truncated = 0
+
+    # find the end of the header block
+    header_end, body_start = find_blank_line(emails, 0, MAX_HEADER_BYTES)
+    if header_end == -1:
+        # flattened email: the body is glued onto the last header
+        head = emails[:] if head_limit is None else emails[:head_limit]
+        body_start = len(emails)
+        if head_limit is not None and head_limit < len(emails):
+            truncated = 1
     else:
-        html_format = False
+        head = emails[:header_end]
 
-    # Split the email into based into different headers 
+    # split the header block into different headers
     for h in headers:
-        if h in emails:
-            emails = emails.replace(f" {h}", f"\n{h}")
-    msg = email.message_from_string(emails)
+        if h in head:
+            head = head.replace(f" {h}", f"\n{h}")
+    msg = email.message_from_string(head)
 
-    # Extract the content and subject of the email
-    content = msg.items()[-1][-1]
-    subject = msg["Subject"]
+    return msg, head, body_start, truncated
 
-    # Initialize variable indicate if it has a image
-    images = None
+
+def read_body(emails, msg, head, body_start, max_body_bytes=None):
+    """
+    Reads the text parts of the body of a parsed email.
+    If max_body_bytes is given, the text parts are read only up to that budget.
+    Attachments are detected from the part headers, their payloads are never decoded or copied.
+    Returns: (content, scanned, attachment_found, truncated)
+    """
+    truncated = 0
+    attachment_found = 0
+
+    # walk the mime parts and keep the text parts within the byte budget
+    texts = []
+    budget = max_body_bytes if max_body_bytes is not None else len(emails)
+    parts = [(msg, body_start, len(emails))]
+    while parts and body_start < len(emails):
+        part, start, end = parts.pop(0)
+        content_type = (part.get("Content-Type") or "text/plain").split(";")[0].strip().lower()
+        content_disp = part.get("Content-Disposition") or ""
+        boundary = part.get_param("boundary") if content_type.startswith("multipart/") else None
+
+        if boundary:
+            # find the sub parts by their delimiter lines without copying the payload
+            delimiter = "\n--" + boundary
+            pos = emails.find(delimiter, start - 1, end)
+            while pos != -1:
+                pos += len(delimiter)
+                if emails.startswith("--", pos):
+                    break
+                part_head_end, part_start = find_blank_line(emails, pos, min(end, pos + MAX_HEADER_BYTES))
+                next_pos = emails.find(delimiter, pos, end)
+                if part_head_end == -1 or (next_pos != -1 and part_head_end > next_pos):
+                    pos = next_pos
+                    continue
+                part_end = next_pos if next_pos != -1 else end
+                # the line break before the next delimiter belongs to the delimiter
+                if part_end > part_start and emails[part_end - 1] == "\r":
+                    part_end -= 1
+                sub_part = email.message_from_string(emails[pos:part_head_end].lstrip("-\r\n"))
+                parts.append((sub_part, part_start, part_end))
+                pos = next_pos
+        elif content_type.startswith("text/") and "attachment" not in content_disp.lower():
+            # read the text part up to the remaining budget
+            size = min(budget, end - start)
+            text = emails[start:start + size] if budget > 0 else ""
+            used = size
+            if max_body_bytes is not None and isinstance(emails, str):
+                # the budget counts utf-8 bytes like for a raw message, so the text read is measured encoded
+                data = text.encode("utf-8")
+                used = min(len(data), budget)
+                if len(data) > budget:
+                    text = data[:budget].decode("utf-8", errors="replace")
+                    truncated = 1
+            if end - start > size:
+                truncated = 1
+            if budget > 0:
+                texts.append(text)
+                budget -= used
+        else:
+            attachment_found = 1
+
+        # the remaining parts cannot change the result anymore
+        if budget <= 0 and attachment_found:
+            if parts:
+                truncated = 1
+            break
+
+    # the flattened email keeps its body in the last header
+    if body_start < len(emails):
+        content = "".join(texts)
+    else:
+        content = msg.items()[-1][-1]
+    scanned = head + content
+
+    return content, scanned, attachment_found, truncated
+
+
+HEADERS = [
+    "Return-Path:",
+    "Delivered-To:",
+    "Received:",
+    "Date:",
+    "From",
+    "To:",
+    "Subject:",
+    "Message-Id:",
+    "Mail-Followup-To:",
+    "References:",
+    "MIME-Version:",
+    "Content-Type:",
+    "Content-Disposition:",
+    "User-Agent:",
+    "Sender:",
+    "Errors-To:",
+    "X-Mailman-Version:",
+    "Precedence:",
+    "List-Id:",
+    "X-Beenthere:",
+    "In-Reply-To:",
+    "load average:",
+    "List maintainer:",
+    "Content-Transfer-Encoding:",
+    "Delivery-Date:",
+    "List-Archive:",
+    "X-Priority:",
+    "X-Msmail-Priority:",
+    "X-Mailer:",
+    "X-Mimeole:",
+    "List-Help:",
+    "List-Post:",
+    "List-Subscribe:",
+    "List-Unsubscribe:"
+]
+
+
+def parse_stage(state):
+    """
+    Parses the header block of the raw email into a message.
+    """
+    max_body_bytes = state["max_body_bytes"]
+    if state["headers_only"]:
+        # no requested column needs the body, so a flattened email is cut like its header block
+        head_limit = MAX_HEADER_BYTES
+    elif max_body_bytes is not None:
+        head_limit = MAX_HEADER_BYTES + max_body_bytes
+    else:
+        head_limit = None
+    msg, head, body_start, truncated1 = parse_headers(state["emails"], HEADERS, head_limit)
+
+    return {
+        "msg": msg,
+        "head": head,
+        "body_start": body_start,
+        "head_truncated": truncated1
+    }
+
+
+def body_stage(state):
+    """
+    Reads the text parts of the email body, in bounded mode only up to the byte budget.
+    """
+    content, scanned, part_attachment, truncated1 = read_body(
+        state["emails"], state["msg"], state["head"], state["body_start"], state["max_body_bytes"]
+    )
+
+    return {
+        "content": content,
+        "scanned": scanned,
+        "part_attachment": part_attachment,
+        "truncated": 1 if truncated1 or state["head_truncated"] else 0
+    }
+
+
+def header_stage(state):
+    """
+    Extracts the features that only need the message headers.
+    """
+    msg = state["msg"]
 
     # extract the content type
     content_type = msg["Content-Type"].split(";")[0] if msg["Content-Type"] else None
@@ -153,6 +302,50 @@ def feature_extraction(emails):
     # check if the email has a list id
     has_list_id1 = 1 if msg["List-Id"] else 0
 
+    # check if the email has a subject
+    has_subject1 = 1 if msg["Subject"] else 0
+
+    # get the number of received headers
+    if msg["Received"]:
+        received_headers = msg.get_all("Received", [])
+        num_received_list1 = len(received_headers)
+    else:
+        num_received_list1 = "None"
+
+    # check if the email is a reply
+    is_replied1 = 1 if msg["In-Reply-To"] or msg["References"] else 0
+
+    return {
+        "content_type_raw": content_type,
+        "content_type": content_type_list1,
+        "content_disp": content_disp_list1,
+        "has_list_id": has_list_id1,
+        "has_subject": has_subject1,
+        "num_received": num_received_list1,
+        "is_replied": is_replied1
+    }
+
+
+def html_stage(state):
+    """
+    Parses the html of the email and extracts the content based features.
+    """
+    msg = state["msg"]
+    content = state["content"]
+    content_type = state["content_type_raw"]
+
+    # Extract the subject of the email
+    subject = msg["Subject"]
+
+    # Initialize variable indicate if it has a image
+    images = None
+
+    # Check if the email is in HTML format
+    if re.search(r"<html|<body|<div|<span|<p>", state["scanned"], re.IGNORECASE):
+        html_format = True
+    else:
+        html_format = False
+
     # if the email is in html format
     if html_format:
         soup = BeautifulSoup(content, "html.parser")
@@ -160,10 +353,8 @@ def feature_extraction(emails):
 
         # get the actual processed content (subject + body)
         if subject:
-            has_subject1 = 1
             process_content = subject + text
         else:
-            has_subject1 = 0
             process_content = text
         process_content_list1 = process_content
 
@@ -183,10 +374,8 @@ def feature_extraction(emails):
     else:
         # get the actual processed content (subject + body)
         if subject:
-            has_subject1 = 1
             process_content = subject + content
         else:
-            has_subject1 = 0
             process_content = content
         process_content_list1 = process_content
 
@@ -203,8 +392,23 @@ def feature_extraction(emails):
     # get the number of exclamation marks
     num_exc_mark1 = process_content.count("!")
 
-    # check if the email has an attachment
-    if images:
+    return {
+        "images": images,
+        "num_html": num_html_list1,
+        "num_exc_mark": num_exc_mark1,
+        "process_content": process_content_list1
+    }
+
+
+def attachment_stage(state):
+    """
+    Checks if the email has an attachment.
+    """
+    msg = state["msg"]
+    content_type = state["content_type_raw"]
+    content_disp = msg["Content-Disposition"]
+
+    if state["images"]:
         has_attachement1 = 1
     elif content_type and content_type.startswith(
         ("image/", "application/", "audio/", "video/")
@@ -217,18 +421,25 @@ def feature_extraction(emails):
         has_attachement1 = 1
     elif content_disp and "attachment" in content_disp.lower():
         has_attachement1 = 1
+    elif state["part_attachment"]:
+        has_attachement1 = 1
     else:
         has_attachement1 = 0
 
+    return {"has_attachement": has_attachement1}
+
+
+def return_path_stage(state):
+    """
+    Extracts the domain of the return path and compares it with the sender.
+    """
+    msg = state["msg"]
+
     if msg["Return-Path"]:
         # get the domain of the return path
         name, return_path = parseaddr(msg["Return-Path"])
         addr_domain = return_path.split("@")[-1].lower()
 
-        # check if the domain has a valid SPF and DKIM record
-        check_spf_list1 = check_spf(addr_domain)
-        check_dkim_list1 = check_dkim(addr_domain)
-
         addr_domain_last = addr_domain.split(".")[-1]
         domain_list1 = addr_domain_last
 
@@ -243,20 +454,38 @@ def feature_extraction(emails):
             from_returnpath_same1 = "None"
 
     else:
+        addr_domain = None
         domain_list1 = "None"
-        check_spf_list1 = "None"
-        check_dkim_list1 = "None"
         from_returnpath_same1 = "None"
 
-    # get the number of received headers
-    if msg["Received"]:
-        received_headers = msg.get_all("Received", [])
-        num_received_list1 = len(received_headers)
-    else:
-        num_received_list1 = "None"
+    return {
+        "addr_domain": addr_domain,
+        "domain": domain_list1,
+        "from_returnpath_same": from_returnpath_same1
+    }
+
+
+def spf_stage(state):
+    """
+    Checks if the return path domain has a valid SPF record.
+    """
+    addr_domain = state["addr_domain"]
+    return {"check_spf": check_spf(addr_domain) if addr_domain is not None else "None"}
 
-    # check if the email is a reply
-    is_replied1 = 1 if msg["In-Reply-To"] or msg["References"] else 0
+
+def dkim_stage(state):
+    """
+    Checks if the return path domain has a DKIM record.
+    """
+    addr_domain = state["addr_domain"]
+    return {"check_dkim": check_dkim(addr_domain) if addr_domain is not None else "None"}
+
+
+def date_stage(state):
+    """
+    Extracts the sending time period and weekday from the date header.
+    """
+    msg = state["msg"]
 
     # extract date from the raw email
     def sending_time(data_match, format_list):
@@ -309,73 +538,289 @@ def feature_extraction(emails):
         time_period1 = "None"
         is_weekday1 = "None"
 
-    return (
-        content_type_list1,
-        content_disp_list1,
-        has_list_id1,
-        num_html_list1,
-        has_subject1,
-        num_exc_mark1,
-        has_attachement1,
-        check_spf_list1,
-        check_dkim_list1,
-        domain_list1,
-        from_returnpath_same1,
-        num_received_list1,
-        is_replied1,
-        time_period1,
-        is_weekday1,
-        process_content_list1
-    )
+    return {"time_period": time_period1, "is_weekday": is_weekday1}
+
+
+# stage name -> (stages it depends on, function computing its values)
+STAGES = {
+    "parse": ([], parse_stage),
+    "body": (["parse"], body_stage),
+    "headers": (["parse"], header_stage),
+    "html": (["body", "headers"], html_stage),
+    "attachment": (["body", "headers", "html"], attachment_stage),
+    "return_path": (["parse"], return_path_stage),
+    "spf": (["return_path"], spf_stage),
+    "dkim": (["return_path"], dkim_stage),
+    "date": (["parse"], date_stage),
+}
+
+# feature column -> stage computing it
+FEATURE_STAGES = {
+    "content_type": "headers",
+    "content_disp": "headers",
+    "has_list_id": "headers",
+    "num_html": "html",
+    "has_subject": "headers",
+    "num_exc_mark": "html",
+    "has_attachement": "attachment",
+    "check_spf": "spf",
+    "check_dkim": "dkim",
+    "domain": "return_path",
+    "from_returnpath_same": "return_path",
+    "num_received": "headers",
+    "is_replied": "headers",
+    "time_period": "date",
+    "is_weekday": "date",
+    "process_content": "html",
+    "truncated": "body",
+}
+
+# the columns returned by feature_extraction() by default, in order
+FEATURES = [
+    "content_type",
+    "content_disp",
+    "has_list_id",
+    "num_html",
+    "has_subject",
+    "num_exc_mark",
+    "has_attachement",
+    "check_spf",
+    "check_dkim",
+    "domain",
+    "from_returnpath_same",
+    "num_received",
+    "is_replied",
+    "time_period",
+    "is_weekday",
+    "process_content"
+]
+
+# the column order of features.csv, followed by labels and process_content
+CSV_COLUMNS = [
+    "has_subject", "content_type", "content_disp",
+    "num_html", "has_attachement", "num_exc_mark", "has_list_id", "domain",
+    "check_spf", "check_dkim", "from_returnpath_same", "num_received",
+    "is_replied", "time_period", "is_weekday"
+]
+
+# cheap columns that only need the message headers
+HEADER_FEATURES = ["content_type", "content_disp", "has_list_id", "has_subject", "num_received", "is_replied"]
+
+
+def run_stage(name, state, done):
+    """
+    Runs a stage after the stages it depends on, each stage at most once.
+    """
+    if name in done:
+        return
+    dependencies, stage = STAGES[name]
+    for dependency in dependencies:
+        run_stage(dependency, state, done)
+    state.update(stage(state))
+    done.add(name)
+
+
+def feature_extraction(emails, max_body_bytes=None, columns=None):
+    """
+    Extracts the metadata features and the actual content of a raw email.
+    Only the stages needed for the requested columns are run, e.g. HEADER_FEATURES only parses the header block and skips the body, html and DNS checks.
+    If max_body_bytes is given, the email is parsed in bounded mode.
+    Returns: a tuple with the value of each column, by default FEATURES plus truncated in bounded mode
+    """
+    if columns is None:
+        columns = FEATURES + ["truncated"] if max_body_bytes is not None else FEATURES
+    for column in columns:
+        if column not in FEATURE_STAGES:
+            raise ValueError(f"unknown feature column: {column}")
+
+    # find every stage the requested columns need
+    needed = set()
+    stages = [FEATURE_STAGES[column] for column in columns]
+    while stages:
+        name = stages.pop()
+        if name not in needed:
+            needed.add(name)
+            stages.extend(STAGES[name][0])
+
+    state = {"emails": emails, "max_body_bytes": max_body_bytes, "headers_only": "body" not in needed}
+    done = set()
+    for column in columns:
+        run_stage(FEATURE_STAGES[column], state, done)
+
+    return tuple(state[column] for column in columns)
+
+
+def feature_extraction_source(source, max_body_bytes=None, columns=None):
+    """
+    Reads one email from an mbox byte range or a Maildir file in the worker and extracts its features.
+    In bounded mode the email stays in a memory map and only the header blocks and the budgeted text are decoded.
+    """
+    if max_body_bytes is None:
+        return feature_extraction(read_message(source), max_body_bytes, columns)
+    with RawMessage(source) as emails:
+        return feature_extraction(emails, max_body_bytes, columns)
+
+
+def check_mailbox(sources, references, max_body_bytes=None):
+    """
+    Compares the features of mailbox messages with the features of the same raw emails read back from a csv cell,
+    the format of spam_assassin.csv the model was trained on. The DNS checks are skipped.
+    Returns: a list of (index, column, mailbox value, reference value) for every mismatch
+    """
+    columns = [c for c in FEATURES if c not in ("check_spf", "check_dkim")]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(["text"])
+    writer.writerows([text] for text in references)
+    buffer.seek(0)
+    texts = pd.read_csv(buffer)["text"].tolist()
+
+    mismatches = []
+    for index, (source, text) in enumerate(zip(sources, texts)):
+        # an email that fails must fail the same way in both formats
+        try:
+            got = feature_extraction_source(source, max_body_bytes, columns)
+        except Exception as e:
+            got = [type(e).__name__] * len(columns)
+        try:
+            expected = feature_extraction(text, max_body_bytes, columns)
+        except Exception as e:
+            expected = [type(e).__name__] * len(columns)
+        for column, a, b in zip(columns, got, expected):
+            if a != b:
+                mismatches.append((index, column, a, b))
+    return mismatches
 
 # use parallel processing to extract features
-from concurrent.futures import ProcessPoolExecutor
 import os
 import multiprocessing
+import argparse
+from functools import partial
+from itertools import islice
+import mailbox
+import sys
+from contextlib import ExitStack
+from robust_extraction import ERROR_COLUMNS, TIMEOUT, iter_isolated, iter_pool
 
 if __name__ == "__main__":
 
-    mp_context = multiprocessing.get_context("fork")
-    with ProcessPoolExecutor(max_workers=os.cpu_count(),mp_context=mp_context) as executor:
-        results = list(executor.map(feature_extraction, map(lambda i: df.iloc[i, 0], range(len(df)))))
-        (
-            content_type_list,
-            content_disp_list,
-            has_list_id,
-            num_html_list,
-            has_subject,
-            num_exc_mark,
-            has_attachement,
-            check_spf_list,
-            check_dkim_list,
-            domain_list,
-            from_returnpath_same,
-            num_received_list,
-            is_replied,
-            time_period,
-            is_weekday,
-            process_content_list
-        ) = zip(*results)
-
-    # save it as csv
-    labels = df["target"].tolist()
-    rows = zip(
-        has_subject, content_type_list, content_disp_list,
-        num_html_list, has_attachement, num_exc_mark, has_list_id, domain_list,
-        check_spf_list, check_dkim_list, from_returnpath_same, num_received_list,
-        is_replied, time_period, is_weekday, labels, process_content_list
+    parser = argparse.ArgumentParser(description="Extract metadata features from spam_assassin.csv, an mbox file or a Maildir tree")
+    parser.add_argument(
+        "--max-body-bytes",
+        type=int,
+        nargs="?",
+        const=MAX_BODY_BYTES,
+        default=None,
+        help=f"parse in bounded mode, reading at most this many bytes of text per email (default {MAX_BODY_BYTES}), a flattened email is read up to {MAX_HEADER_BYTES} bytes more for its headers"
     )
+    parser.add_argument(
+        "--robust",
+        action="store_true",
+        help="isolate every email in a supervised worker and write failures to features_errors.csv"
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=TIMEOUT,
+        help=f"wall-clock budget in seconds per email in robust mode (default {TIMEOUT})"
+    )
+    parser.add_argument(
+        "--columns",
+        default=None,
+        help="comma separated feature columns to extract, only the stages they need are run (default all)"
+    )
+    inputs = parser.add_mutually_exclusive_group()
+    inputs.add_argument("--mbox", default=None, help="read the emails from this mbox file instead of spam_assassin.csv")
+    inputs.add_argument("--maildir", default=None, help="read the emails from this Maildir tree instead of spam_assassin.csv")
+    parser.add_argument(
+        "--label",
+        default="None",
+        help="label written for every email of an mbox or Maildir input (default None)"
+    )
+    parser.add_argument(
+        "--check",
+        type=int,
+        default=None,
+        metavar="N",
+        help="compare the features of the first N mbox or Maildir messages with the same emails read as csv rows and exit"
+    )
+    args = parser.parse_args()
+
+    if args.check is not None:
+        if not (args.mbox or args.maildir):
+            parser.error("--check needs --mbox or --maildir")
+        # the reference emails are read with the mailbox module of the standard library, not our own indexing
+        if args.mbox:
+            sources = list(islice(iter_mbox(args.mbox), args.check))
+            box = mailbox.mbox(args.mbox)
+            references = [box.get_bytes(key).decode("utf-8", errors="replace") for key in islice(box.iterkeys(), args.check)]
+        else:
+            sources = list(islice(iter_maildir(args.maildir), args.check))
+            references = []
+            for path in sources:
+                with open(path, "rb") as f:
+                    references.append(f.read().decode("utf-8", errors="replace"))
+        if len(sources) != len(references):
+            sys.exit(f"found {len(sources)} messages but the mailbox module found {len(references)}")
+        mismatches = check_mailbox(sources, references, args.max_body_bytes)
+        for index, column, got, expected in mismatches:
+            print(f"email {index}: {column} is {repr(got)[:80]} from the mailbox but {repr(expected)[:80]} from a csv row")
+        print(f"{len(mismatches)} mismatches in {len(sources)} emails")
+        sys.exit(1 if mismatches else 0)
+
+    columns = args.columns.split(",") if args.columns else FEATURES
+    for column in columns:
+        if column not in FEATURE_STAGES or column == "truncated":
+            parser.error(f"unknown feature column: {column}")
 
-    headers = [
-        "has_subject", "content_type", "content_disp", 
-        "num_html", "has_attachement", "num_exc_mark", "has_list_id", "domain",
-        "check_spf", "check_dkim", "from_returnpath_same", "num_received",
-        "is_replied", "time_period", "is_weekday", "labels", "process_content"
-    ]
-
-    with open("features.csv", "w", newline = "") as f:
-        writer = csv.writer(f)
+    mp_context = multiprocessing.get_context("fork")
+    extract_columns = columns + ["truncated"] if args.max_body_bytes is not None else columns
+    if args.mbox or args.maildir:
+        # the workers read every email from its byte range or file, the corpus never passes through this process
+        extract = partial(feature_extraction_source, max_body_bytes=args.max_body_bytes, columns=extract_columns)
+        emails = iter_mbox(args.mbox) if args.mbox else iter_maildir(args.maildir)
+    else:
+        df = pd.read_csv("spam_assassin.csv")
+        extract = partial(feature_extraction, max_body_bytes=args.max_body_bytes, columns=extract_columns)
+        emails = map(lambda i: df.iloc[i, 0], range(len(df)))
+    if args.robust:
+        results = iter_isolated(extract, emails, args.timeout, os.cpu_count(), mp_context)
+    else:
+        results = ((i, r, None) for i, r in enumerate(iter_pool(extract, emails, os.cpu_count(), mp_context)))
+
+    # column order the notebook expects
+    headers = [c for c in CSV_COLUMNS if c in columns] + ["labels"]
+    if "process_content" in columns:
+        headers.append("process_content")
+    if not (args.mbox or args.maildir):
+        labels = df["target"]
+
+    # stream every row to the csv files as soon as its email is done, so the results never pile up here
+    num_emails = 0
+    num_errors = 0
+    with ExitStack() as stack:
+        writer = csv.writer(stack.enter_context(open("features.csv", "w", newline = "")))
         writer.writerow(headers)
-        writer.writerows(rows)
-
-
+        if args.max_body_bytes is not None:
+            # record which emails were truncated in bounded mode
+            truncated_writer = csv.writer(stack.enter_context(open("features_truncated.csv", "w", newline = "")))
+            truncated_writer.writerow(["index", "truncated"])
+        if args.robust:
+            errors_writer = csv.writer(stack.enter_context(open("features_errors.csv", "w", newline = "")))
+            errors_writer.writerow(ERROR_COLUMNS)
+
+        for index, result, error in results:
+            num_emails += 1
+            if error is not None:
+                num_errors += 1
+                errors_writer.writerow((index,) + tuple(error))
+                continue
+            if args.max_body_bytes is not None:
+                truncated_writer.writerow([index, result[-1]])
+                result = result[:-1]
+            label = args.label if args.mbox or args.maildir else labels.iloc[index]
+            values = dict(zip(columns, result), labels=label)
+            writer.writerow([values[h] for h in headers])
+
+    if args.robust:
+        print(f"{num_errors} of {num_emails} emails failed, see features_errors.csv")
@@ -10,12 +10,15 @@ import csv
 import json
 from pathlib import Path
 
-# load the hard spam dataset from folder and convert its json format to a pandas dataframe
-spam_files = [json.load(open(f, "r", encoding = "utf-8")) for f in Path('hard_spam').iterdir()]
-rows = []
-for i in spam_files:
-    rows.append({'text': i['text'], 'target': 1})
-df = pd.DataFrame(rows)
+def load_hard_spam(files):
+    """
+    Loads the hard spam json files and converts them to a pandas dataframe.
+    """
+    rows = []
+    for f in files:
+        with open(f, "r", encoding = "utf-8") as fp:
+            rows.append({'text': json.load(fp)['text'], 'target': 1})
+    return pd.DataFrame(rows, columns = ['text', 'target'])
 
 def check_spf(domain):
     """
@@ -364,42 +367,37 @@ def feature_extraction(emails):
     )
 
 # use parallel processing to extract features
-from concurrent.futures import ProcessPoolExecutor
 import os
 import multiprocessing
+import argparse
+from contextlib import ExitStack
+from robust_extraction import ERROR_COLUMNS, TIMEOUT, iter_isolated, iter_pool
 
 if __name__ == "__main__":
 
-    mp_context = multiprocessing.get_context("fork")
-    with ProcessPoolExecutor(max_workers=os.cpu_count(),mp_context=mp_context) as executor:
-        results = list(executor.map(feature_extraction, map(lambda i: df.iloc[i, 0], range(len(df)))))
-        (
-            content_type_list,
-            content_disp_list,
-            has_list_id,
-            num_html_list,
-            has_subject,
-            num_exc_mark,
-            has_attachement,
-            check_spf_list,
-            check_dkim_list,
-            domain_list,
-            from_returnpath_same,
-            num_received_list,
-            is_replied,
-            time_period,
-            is_weekday,
-            process_content_list
-        ) = zip(*results)
-
-    # save it as csv
-    labels = df["target"].tolist()
-    rows = zip(
-        has_subject, content_type_list, content_disp_list,
-        num_html_list, has_attachement, num_exc_mark, has_list_id, domain_list,
-        check_spf_list, check_dkim_list, from_returnpath_same, num_received_list,
-        is_replied, time_period, is_weekday, labels, process_content_list
+    parser = argparse.ArgumentParser(description="Extract metadata features from the hard_spam folder")
+    parser.add_argument(
+        "--robust",
+        action="store_true",
+        help="isolate every email in a supervised worker and write failures to features_hard_spam_errors.csv"
     )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=TIMEOUT,
+        help=f"wall-clock budget in seconds per email in robust mode (default {TIMEOUT})"
+    )
+    args = parser.parse_args()
+
+    # load the hard spam dataset from folder
+    df = load_hard_spam(Path('hard_spam').iterdir())
+
+    mp_context = multiprocessing.get_context("fork")
+    emails = map(lambda i: df.iloc[i, 0], range(len(df)))
+    if args.robust:
+        results = iter_isolated(feature_extraction, emails, args.timeout, os.cpu_count(), mp_context)
+    else:
+        results = ((i, r, None) for i, r in enumerate(iter_pool(feature_extraction, emails, os.cpu_count(), mp_context)))
 
     headers = [
         "has_subject", "content_type", "content_disp", 
@@ -408,9 +406,45 @@ if __name__ == "__main__":
         "is_replied", "time_period", "is_weekday", "labels", "process_content"
     ]
 
-    with open("features_hard_spam.csv", "w", newline = "") as f:
-        writer = csv.writer(f)
+    # save it as csv, writing every row as soon as its email is done
+    num_errors = 0
+    with ExitStack() as stack:
+        writer = csv.writer(stack.enter_context(open("features_hard_spam.csv", "w", newline = "")))
         writer.writerow(headers)
-        writer.writerows(rows)
-
-
+        if args.robust:
+            errors_writer = csv.writer(stack.enter_context(open("features_hard_spam_errors.csv", "w", newline = "")))
+            errors_writer.writerow(ERROR_COLUMNS)
+
+        for index, result, error in results:
+            if error is not None:
+                num_errors += 1
+                errors_writer.writerow((index,) + tuple(error))
+                continue
+            (
+                content_type,
+                content_disp,
+                has_list_id,
+                num_html,
+                has_subject,
+                num_exc_mark,
+                has_attachement,
+                spf_result,
+                dkim_result,
+                domain,
+                from_returnpath_same,
+                num_received,
+                is_replied,
+                time_period,
+                is_weekday,
+                process_content
+            ) = result
+            # the dns results get their own names, check_spf and check_dkim are the functions the workers run
+            writer.writerow([
+                has_subject, content_type, content_disp,
+                num_html, has_attachement, num_exc_mark, has_list_id, domain,
+                spf_result, dkim_result, from_returnpath_same, num_received,
+                is_replied, time_period, is_weekday, df["target"].iloc[index], process_content
+            ])
+
+    if args.robust:
+        print(f"{num_errors} of {len(df)} emails failed, see features_hard_spam_errors.csv")
@@ -0,0 +1,144 @@
+import mmap
+import os
+from array import array
+
+# memory maps of the mbox files opened by this process
+_mbox_maps = {}
+
+
+def index_mbox(path):
+    """
+    Indexes the message boundaries of an mbox file in one scan over a memory map.
+    Returns: (starts, ends) arrays with the byte range of every message, without its "From " line
+    and the blank separator line, the same ranges as the mailbox module of the standard library
+    """
+    starts = array("q")
+    ends = array("q")
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return starts, ends
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mm, "madvise"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            size = len(mm)
+            if mm[:5] == b"From ":
+                pos = 0
+            else:
+                pos = mm.find(b"\nFrom ")
+                pos = pos + 1 if pos != -1 else -1
+            while pos != -1:
+                # the message starts after the "From " separator line
+                line_end = mm.find(b"\n", pos)
+                if line_end == -1:
+                    break
+                next_from = mm.find(b"\nFrom ", line_end)
+                end = next_from + 1 if next_from != -1 else size
+                # the blank line before the next "From " line is a separator, not part of the message
+                if end - 1 > line_end and mm[end - 2:end] == b"\n\n":
+                    end -= 1
+                starts.append(line_end + 1)
+                ends.append(end)
+                pos = next_from + 1 if next_from != -1 else -1
+    return starts, ends
+
+
+def iter_mbox(path):
+    """
+    Yields a (path, start, end) byte range for every message of an mbox file.
+    """
+    path = os.path.abspath(path)
+    starts, ends = index_mbox(path)
+    for start, end in zip(starts, ends):
+        yield path, start, end
+
+
+def iter_maildir(path):
+    """
+    Lazily yields the path of every message of a Maildir tree, including its Maildir++ sub folders.
+    """
+    folders = [os.path.abspath(path)]
+    while folders:
+        folder = folders.pop()
+        for sub in ("new", "cur"):
+            sub_folder = os.path.join(folder, sub)
+            if not os.path.isdir(sub_folder):
+                continue
+            with os.scandir(sub_folder) as entries:
+                for entry in entries:
+                    if entry.is_file() and not entry.name.startswith("."):
+                        yield entry.path
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.name.startswith(".") and entry.is_dir():
+                    folders.append(entry.path)
+
+
+def map_mbox(path):
+    """
+    Returns: the memory map of an mbox file, mapped once per process.
+    """
+    mm = _mbox_maps.get(path)
+    if mm is None:
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        _mbox_maps[path] = mm
+    return mm
+
+
+def read_message(source):
+    """
+    Reads one raw email from a (path, start, end) byte range of an mbox file or the path of a Maildir file.
+    Each process maps an mbox file once and decodes the range straight out of the map.
+    """
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            return f.read().decode("utf-8", errors="replace")
+
+    path, start, end = source
+    with memoryview(map_mbox(path))[start:end] as view:
+        return str(view, "utf-8", "replace")
+
+
+class RawMessage:
+    """
+    A raw email left in the memory map of its mbox or Maildir file, for the bounded parser.
+    It has the few str methods the parser uses, with byte offsets, and decodes only the slices that are read,
+    so a message of any size is never loaded whole.
+    """
+
+    def __init__(self, source):
+        self.owned = isinstance(source, str)
+        if self.owned:
+            with open(source, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+            self.start, self.end = 0, size
+        else:
+            path, self.start, self.end = source
+            self.buffer = map_mbox(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self.owned and self.end:
+            self.buffer.close()
+
+    def __len__(self):
+        return self.end - self.start
+
+    def find(self, sub, start=0, end=None):
+        end = len(self) if end is None else min(end, len(self))
+        pos = self.buffer.find(sub.encode("utf-8"), self.start + max(start, 0), self.start + max(end, 0))
+        return pos - self.start if pos != -1 else -1
+
+    def startswith(self, prefix, pos=0):
+        return self.find(prefix, pos, pos + len(prefix.encode("utf-8"))) == pos
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, end, _ = key.indices(len(self))
+            return self.buffer[self.start + start:self.start + max(start, end)].decode("utf-8", errors="replace")
+        if key < 0:
+            key += len(self)
+        return chr(self.buffer[self.start + key])
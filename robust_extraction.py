@@ -0,0 +1,167 @@
+import csv
+import multiprocessing
+import os
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.connection import wait
+
+# default wall-clock budget in seconds for one email
+TIMEOUT = 60
+# columns of the csv sidecar with the failed emails
+ERROR_COLUMNS = ["index", "error_type", "message"]
+
+
+def worker_loop(func, conn):
+    """
+    Runs in a worker process: receives (index, email) tasks and sends back (index, ok, result or error).
+    """
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+        index, emails = task
+        try:
+            conn.send((index, True, func(emails)))
+        except Exception as e:
+            error = traceback.format_exception_only(type(e), e)[-1].strip()
+            conn.send((index, False, (type(e).__name__, error)))
+
+
+def start_worker(func, mp_context):
+    """
+    Starts one worker process.
+    Returns: (process, connection)
+    """
+    parent_conn, child_conn = mp_context.Pipe()
+    process = mp_context.Process(target=worker_loop, args=(func, child_conn), daemon=True)
+    process.start()
+    child_conn.close()
+    return process, parent_conn
+
+
+def iter_isolated(func, emails, timeout=TIMEOUT, max_workers=None, mp_context=None, window=None):
+    """
+    Applies func to every email in its own worker process with a wall-clock budget per email.
+    Exceptions and timeouts are caught per email, and a worker that hangs or dies is replaced.
+    Emails are read from the iterator as workers free up, and at most window emails are running
+    or waiting to be yielded, so neither the input nor the results pile up in this process.
+    Returns: a generator of (index, result, error) in input order, where a failed email
+    has result None and error (error_type, message)
+    """
+    if mp_context is None:
+        mp_context = multiprocessing.get_context("fork")
+    if max_workers is None:
+        max_workers = os.cpu_count()
+    if window is None:
+        window = 4 * max_workers
+
+    tasks = enumerate(emails)
+    exhausted = False
+    submitted = 0
+    next_index = 0
+    # finished emails waiting for the ones before them, index -> (result, error)
+    finished = {}
+    # worker connection -> (process, index of the running email, deadline)
+    workers = {}
+    idle = []
+
+    def recycle(conn, error_type, message):
+        process, index, deadline = workers.pop(conn)
+        finished[index] = (None, (error_type, message))
+        process.kill()
+        process.join()
+        conn.close()
+        idle.append(start_worker(func, mp_context))
+
+    try:
+        for _ in range(max_workers):
+            idle.append(start_worker(func, mp_context))
+
+        while True:
+            while next_index in finished:
+                result, error = finished.pop(next_index)
+                yield next_index, result, error
+                next_index += 1
+
+            # hand out new emails while the window has room
+            while idle and not exhausted and submitted - next_index < window:
+                task = next(tasks, None)
+                if task is None:
+                    exhausted = True
+                    break
+                process, conn = idle.pop()
+                conn.send(task)
+                workers[conn] = (process, task[0], time.monotonic() + timeout)
+                submitted += 1
+            if not workers:
+                break
+
+            now = time.monotonic()
+            next_deadline = min(deadline for _, _, deadline in workers.values())
+            for conn in wait(list(workers), timeout=max(next_deadline - now, 0)):
+                try:
+                    index, ok, payload = conn.recv()
+                except (EOFError, OSError):
+                    # the worker process died in the middle of an email
+                    process = workers[conn][0]
+                    process.join(1)
+                    recycle(conn, "WorkerDied", f"worker exited with code {process.exitcode}")
+                    continue
+                process = workers.pop(conn)[0]
+                finished[index] = (payload, None) if ok else (None, payload)
+                idle.append((process, conn))
+
+            # kill the workers that are over their budget
+            now = time.monotonic()
+            for conn, (process, index, deadline) in list(workers.items()):
+                if now >= deadline:
+                    recycle(conn, "Timeout", f"no result after {timeout} seconds")
+    finally:
+        # stop the idle workers and kill the busy ones, also when the caller stops early
+        for process, conn in idle:
+            try:
+                conn.send(None)
+            except OSError:
+                process.kill()
+        for conn, (process, index, deadline) in workers.items():
+            process.kill()
+        for process, conn in idle + [(process, conn) for conn, (process, _, _) in workers.items()]:
+            process.join()
+            conn.close()
+
+
+def iter_pool(func, emails, max_workers=None, mp_context=None, window=None):
+    """
+    Applies func to every email in a process pool, reading the emails as results are taken
+    and keeping at most window emails in flight. An exception stops the run like Executor.map.
+    Returns: a generator of the results in input order
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count()
+    if window is None:
+        window = 4 * max_workers
+
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context) as executor:
+        in_flight = deque()
+        try:
+            for email in emails:
+                in_flight.append(executor.submit(func, email))
+                if len(in_flight) >= window:
+                    yield in_flight.popleft().result()
+            while in_flight:
+                yield in_flight.popleft().result()
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+
+def write_errors(errors, path):
+    """
+    Writes the failed emails with their index to a csv sidecar file.
+    """
+    with open(path, "w", newline = "") as f:
+        writer = csv.writer(f)
+        writer.writerow(ERROR_COLUMNS)
+        writer.writerows(errors)
@@ -0,0 +1,375 @@
+import argparse
+import csv
+import hashlib
+import heapq
+import json
+import mmap
+import os
+import subprocess
+import sys
+import multiprocessing
+from collections import deque
+from pathlib import Path
+
+import pandas as pd
+
+import feature_extraction
+import feature_extraction_hard_spam
+from feature_extraction import CSV_COLUMNS, FEATURES
+from mail_ingestion import index_mbox, iter_maildir
+from robust_extraction import ERROR_COLUMNS, TIMEOUT, iter_isolated, iter_pool, write_errors
+
+# the column layout of the merged output, same as features.csv
+OUTPUT_COLUMNS = CSV_COLUMNS + ["labels", "process_content"]
+# rows of a csv input parsed at a time
+CHUNK_SIZE = 1000
+
+
+def file_checksum(path):
+    """
+    Returns: the sha256 hex digest of a file, read in chunks.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def shard_of(key, num_shards):
+    """
+    Hash partitions an item key into a shard, stable across hosts and python runs.
+    """
+    return int(hashlib.md5(str(key).encode("utf-8")).hexdigest(), 16) % num_shards
+
+
+def list_items(input_path):
+    """
+    Lists the items of an input in their original order.
+    Returns: (kind, keys)
+    """
+    input_path = Path(input_path)
+    if (input_path / "cur").is_dir() or (input_path / "new").is_dir():
+        # a Maildir tree, keyed by the path of every message inside it
+        return "maildir", sorted(os.path.relpath(p, input_path) for p in iter_maildir(input_path))
+
+    if input_path.is_dir():
+        # a folder of json emails like hard_spam, keyed by file name
+        return "json", sorted(f.name for f in input_path.glob("*.json"))
+
+    if input_path.suffix != ".csv":
+        # an mbox file, keyed by the byte range of every message
+        starts, ends = index_mbox(input_path)
+        return "mbox", [[start, end] for start, end in zip(starts, ends)]
+
+    # a csv of raw emails like spam_assassin.csv, keyed by row number and counted in chunks
+    num_rows = sum(len(chunk) for chunk in pd.read_csv(input_path, chunksize=CHUNK_SIZE))
+    return "csv", list(range(num_rows))
+
+
+def iter_input(kind, input_path, keys):
+    """
+    Streams the emails of the given keys, in the order of the keys.
+    A csv cannot be indexed without parsing it, so it is still scanned in chunks, but only the rows of the keys are kept.
+    Returns: a generator of (email or its source for the workers, label, raw content for the checksum)
+    """
+    if kind == "json":
+        folder = Path(input_path)
+        for key in keys:
+            with open(folder / key, "rb") as f:
+                content = f.read()
+            yield json.loads(content)["text"], 1, content
+
+    elif kind == "maildir":
+        # the workers read the messages themselves, labels are unknown
+        folder = os.path.abspath(input_path)
+        for key in keys:
+            path = os.path.join(folder, key)
+            with open(path, "rb") as f:
+                content = f.read()
+            yield path, "None", content
+
+    elif kind == "mbox":
+        path = os.path.abspath(input_path)
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        try:
+            # the workers read the messages themselves, the checksum is taken straight from the map
+            for start, end in keys:
+                if end > size:
+                    raise ValueError(f"{input_path} is shorter than the manifest")
+                with memoryview(mm)[start:end] as view:
+                    yield (path, start, end), "None", view
+        finally:
+            if size:
+                mm.close()
+
+    else:
+        keys = iter(keys)
+        key = next(keys, None)
+        offset = 0
+        for chunk in pd.read_csv(input_path, chunksize=CHUNK_SIZE):
+            while key is not None and key < offset + len(chunk):
+                text = chunk.iloc[key - offset, 0]
+                yield text, chunk["target"].iloc[key - offset], str(text).encode("utf-8")
+                key = next(keys, None)
+            if key is None:
+                break
+            offset += len(chunk)
+        if key is not None:
+            raise ValueError(f"{input_path} has fewer rows than the manifest")
+
+
+def shard_checksum(kind, input_path, keys):
+    """
+    Returns: the sha256 hex digest of the contents of the emails of a shard, in their order.
+    """
+    digest = hashlib.sha256()
+    for _, _, content in iter_input(kind, input_path, keys):
+        digest.update(hashlib.sha256(content).digest())
+    return digest.hexdigest()
+
+
+def plan(input_path, num_shards, shard_dir):
+    """
+    Splits an input into hash partitioned shards and writes their manifest
+    with a checksum of the contents of every shard.
+    """
+    kind, keys = list_items(input_path)
+    shards = [[] for _ in range(num_shards)]
+    for index, key in enumerate(keys):
+        shards[shard_of(key, num_shards)].append([index, key])
+
+    checksums = [shard_checksum(kind, input_path, [key for _, key in items]) for items in shards]
+
+    manifest = {
+        "input": str(input_path),
+        "kind": kind,
+        "checksum": hashlib.sha256("".join(checksums).encode("utf-8")).hexdigest(),
+        "num_items": len(keys),
+        "shards": [
+            {"shard": k, "checksum": checksum, "items": items}
+            for k, (checksum, items) in enumerate(zip(checksums, shards))
+        ]
+    }
+    shard_dir = Path(shard_dir)
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    with open(shard_dir / "manifest.json", "w") as f:
+        json.dump(manifest, f)
+    return manifest
+
+
+def load_manifest(shard_dir):
+    with open(Path(shard_dir) / "manifest.json") as f:
+        return json.load(f)
+
+
+def shard_path(shard_dir, shard, suffix):
+    return Path(shard_dir) / f"shard-{shard:04d}{suffix}"
+
+
+def work(shard_dir, shard, robust=False, timeout=TIMEOUT, max_workers=None):
+    """
+    Extracts the features of one shard and writes them with a receipt holding their checksums.
+    Only the emails of the shard are read, and their contents are checked against the manifest
+    before the extraction starts and again while it runs.
+    """
+    manifest = load_manifest(shard_dir)
+    items = manifest["shards"][shard]["items"]
+    keys = [key for _, key in items]
+    checksum = manifest["shards"][shard]["checksum"]
+    # a stale or changed input is rejected before any email is extracted
+    if shard_checksum(manifest["kind"], manifest["input"], keys) != checksum:
+        raise ValueError(f"the emails of shard {shard} do not match the manifest checksum")
+    if manifest["kind"] == "json":
+        extract = feature_extraction_hard_spam.feature_extraction
+    elif manifest["kind"] == "csv":
+        extract = feature_extraction.feature_extraction
+    else:
+        extract = feature_extraction.feature_extraction_source
+
+    # the labels wait here until the result of their email comes back, in the same order
+    labels = deque()
+    digest = hashlib.sha256()
+
+    def emails():
+        for email, label, content in iter_input(manifest["kind"], manifest["input"], keys):
+            digest.update(hashlib.sha256(content).digest())
+            labels.append(label)
+            yield email
+
+    mp_context = multiprocessing.get_context("fork")
+    if robust:
+        results = iter_isolated(extract, emails(), timeout, max_workers, mp_context)
+    else:
+        results = ((i, r, None) for i, r in enumerate(iter_pool(extract, emails(), max_workers, mp_context)))
+
+    # stream the rows ordered by their original index, then rename so a partial file never looks complete
+    output = shard_path(shard_dir, shard, ".csv")
+    tmp = output.with_suffix(".csv.tmp")
+    errors_output = shard_path(shard_dir, shard, "_errors.csv")
+    errors_tmp = errors_output.with_suffix(".csv.tmp")
+    rows = 0
+    num_errors = 0
+    with open(tmp, "w", newline = "") as f, open(errors_tmp, "w", newline = "") as f_errors:
+        writer = csv.writer(f)
+        writer.writerow(["index"] + OUTPUT_COLUMNS)
+        errors_writer = csv.writer(f_errors)
+        errors_writer.writerow(ERROR_COLUMNS)
+        for i, result, error in results:
+            # report the failed emails with their index in the original input
+            index = items[i][0]
+            label = labels.popleft()
+            if error is not None:
+                errors_writer.writerow((index,) + tuple(error))
+                num_errors += 1
+                continue
+            values = dict(zip(FEATURES, result), labels=label)
+            writer.writerow([index] + [values[c] for c in OUTPUT_COLUMNS])
+            rows += 1
+
+    # the input changed while the shard was extracted
+    if digest.hexdigest() != checksum:
+        os.remove(tmp)
+        os.remove(errors_tmp)
+        raise ValueError(f"the emails of shard {shard} do not match the manifest checksum")
+    os.replace(tmp, output)
+    os.replace(errors_tmp, errors_output)
+
+    receipt = {
+        "shard": shard,
+        "checksum": manifest["checksum"],
+        "rows": rows,
+        "errors": num_errors,
+        "sha256": file_checksum(output),
+        "errors_sha256": file_checksum(errors_output)
+    }
+    with open(shard_path(shard_dir, shard, ".json"), "w") as f:
+        json.dump(receipt, f)
+    return receipt
+
+
+def read_shard(path):
+    """
+    Streams the rows of a shard file as (index, row).
+    """
+    with open(path, newline = "") as f:
+        reader = csv.reader(f)
+        next(reader)
+        for row in reader:
+            yield int(row[0]), row[1:]
+
+
+def merge(shard_dir, output, errors_output=None):
+    """
+    Verifies every shard against its receipt and merges them into one csv in the original order.
+    """
+    csv.field_size_limit(sys.maxsize)
+    manifest = load_manifest(shard_dir)
+
+    paths = []
+    errors = []
+    for shard in manifest["shards"]:
+        k = shard["shard"]
+        receipt_path = shard_path(shard_dir, k, ".json")
+        if not receipt_path.exists():
+            raise ValueError(f"shard {k} is not complete")
+        with open(receipt_path) as f:
+            receipt = json.load(f)
+        if receipt["checksum"] != manifest["checksum"]:
+            raise ValueError(f"shard {k} was extracted from a different input")
+        if file_checksum(shard_path(shard_dir, k, ".csv")) != receipt["sha256"]:
+            raise ValueError(f"shard {k} does not match its checksum")
+        if file_checksum(shard_path(shard_dir, k, "_errors.csv")) != receipt["errors_sha256"]:
+            raise ValueError(f"the errors of shard {k} do not match their checksum")
+        if receipt["rows"] + receipt["errors"] != len(shard["items"]):
+            raise ValueError(f"shard {k} is missing emails")
+        paths.append(shard_path(shard_dir, k, ".csv"))
+
+        with open(shard_path(shard_dir, k, "_errors.csv"), newline = "") as f:
+            reader = csv.reader(f)
+            next(reader)
+            errors.extend((int(row[0]), row[1], row[2]) for row in reader)
+
+    # every shard is sorted by index, so a k-way merge restores the original order
+    with open(output, "w", newline = "") as f:
+        writer = csv.writer(f)
+        writer.writerow(OUTPUT_COLUMNS)
+        for index, row in heapq.merge(*(read_shard(p) for p in paths), key=lambda r: r[0]):
+            writer.writerow(row)
+
+    if errors_output:
+        write_errors(sorted(errors), errors_output)
+    return len(errors)
+
+
+def run_local(input_path, num_shards, shard_dir, output, robust=False, timeout=TIMEOUT, errors_output=None):
+    """
+    Plans the shards, runs every shard worker as a separate process on this machine and merges them.
+    The failed emails of every shard are merged into errors_output, by default <output>_errors.csv.
+    """
+    if errors_output is None:
+        errors_output = Path(output).with_name(Path(output).stem + "_errors.csv")
+    plan(input_path, num_shards, shard_dir)
+    max_workers = max(1, (os.cpu_count() or 1) // num_shards)
+    workers = []
+    for shard in range(num_shards):
+        command = [
+            sys.executable, __file__, "work", shard_dir, str(shard),
+            "--max-workers", str(max_workers), "--timeout", str(timeout)
+        ]
+        if robust:
+            command.append("--robust")
+        workers.append(subprocess.Popen(command))
+    failed = [shard for shard, p in enumerate(workers) if p.wait() != 0]
+    if failed:
+        raise RuntimeError(f"shard workers failed: {failed}")
+    return merge(shard_dir, output, errors_output)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Extract features in hash partitioned shards that can run on separate hosts")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    plan_parser = commands.add_parser("plan", help="split the input into shards and write their manifest")
+    plan_parser.add_argument("input", help="a csv like spam_assassin.csv, a folder of json emails like hard_spam, an mbox file or a Maildir tree")
+    plan_parser.add_argument("shard_dir")
+    plan_parser.add_argument("--shards", type=int, required=True)
+
+    work_parser = commands.add_parser("work", help="extract the features of one shard")
+    work_parser.add_argument("shard_dir")
+    work_parser.add_argument("shard", type=int)
+    work_parser.add_argument("--max-workers", type=int, default=None)
+
+    merge_parser = commands.add_parser("merge", help="verify the finished shards and merge them in the original order")
+    merge_parser.add_argument("shard_dir")
+    merge_parser.add_argument("output")
+    merge_parser.add_argument("--errors", default=None, help="also write the failed emails of every shard to this csv")
+
+    local_parser = commands.add_parser("local", help="plan, run every shard as a separate process and merge")
+    local_parser.add_argument("input")
+    local_parser.add_argument("shard_dir")
+    local_parser.add_argument("output")
+    local_parser.add_argument("--shards", type=int, required=True)
+    local_parser.add_argument("--errors", default=None, help="csv for the failed emails of every shard (default <output>_errors.csv)")
+
+    for p in (work_parser, local_parser):
+        p.add_argument("--robust", action="store_true", help="isolate every email and keep going on failures")
+        p.add_argument("--timeout", type=float, default=TIMEOUT, help="wall-clock budget in seconds per email in robust mode")
+
+    args = parser.parse_args()
+
+    if args.command == "plan":
+        manifest = plan(args.input, args.shards, args.shard_dir)
+        print(f"{manifest['num_items']} emails in {args.shards} shards")
+    elif args.command == "work":
+        receipt = work(args.shard_dir, args.shard, args.robust, args.timeout, args.max_workers)
+        print(f"shard {args.shard}: {receipt['rows']} rows, {receipt['errors']} errors")
+    elif args.command == "merge":
+        num_errors = merge(args.shard_dir, args.output, args.errors)
+        print(f"merged into {args.output}, {num_errors} emails failed")
+    else:
+        num_errors = run_local(args.input, args.shards, args.shard_dir, args.output, args.robust, args.timeout, args.errors)
+        print(f"merged into {args.output}, {num_errors} emails failed")